@@ -1,12 +1,48 @@
 import argparse
+import concurrent.futures
+import datetime
 import dateutil.parser
+import functools
+import glob
 import subprocess
-import shutil
 import yaml
 import json
 import re
 import os
 
+try:
+    import orjson
+except ImportError:  # optional fast path, stdlib json is the fallback
+    orjson = None
+
+import gpmf
+import mp4probe
+
+
+@functools.lru_cache(maxsize=8)
+def _load_config(config_path):
+    with open(config_path, "r") as cfg:
+        # libyaml's C loader parses much faster when it is available
+        loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+        return yaml.load(cfg, Loader=loader)["gopro2"]
+
+
+BASENAME_RE = re.compile(r"G[HXOP\d][AP\d][AR\d]\d{4}")
+
+# See https://gopro.com/help/articles/How_To/How-to-Find-Your-GoPro-Serial-Number
+# One alternation so the filename is scanned once instead of nine times
+SERIAL_RE = re.compile(
+    r"C33.{11}"  # GoPro HERO (2018).  14 char beginning with "C33"
+    r"|C322.{10}"  # HERO6 Black.        14 char beginning with "C322"
+    r"|C32.{11}"  # HERO5 Session.      14 char beginning with "C32"
+    r"|C31.{11}"  # HERO5 Black, HERO4, HERO Session, HERO4 Session, HERO+ LCD, HERO+, HERO. 14 char beginning with "C31"
+    r"|H3.{13}"  # HERO3+.             15-char beginning with "H3"
+    r"|HD3.{12}"  # HERO3.              15 char beginning with "HD3"
+    r"|H2.{12}"  # HD HERO2.           14 char beginning with "H2"
+    r"|HD2.{11}"  # HD HERO 960.        14 char beginning with "HD2"
+    r"|HD1.{10}"  # HD HERO (Original). 13 char beginning with "HD1"
+)
+
 
 class GoProTelemetry(object):
     def __init__(
@@ -18,11 +54,10 @@ class GoProTelemetry(object):
         config_path="config.yml",
     ):
         GoProTelemetry.ensure_valid_path(video_path)
-        self.ffprobe_streams = GoProTelemetry.get_ffprobe_streams(video_path)
-        GoProTelemetry.ensure_valid_gopro_video(video_path, self.ffprobe_streams)
         self.reprocess = reprocess
-        self.gopro2gpx_path = None
-        self.gopro2json_path = None
+        self.telemetry = None
+        self._fdsc_serial = None
+        self._ffprobe_streams = None
         self.gpmdinfo_path = None
         self.load_executables(config_path)
         # Instantiate attributes
@@ -30,104 +65,158 @@ class GoProTelemetry(object):
         self.filename = os.path.basename(video_path)
         self.video_path = os.path.abspath(video_path)
         self.basename = self.get_basename()
-        self.telemetry_path = "{}.bin".format(video_path)
-
-        if prepend_filename_with_serial:
-            print("Prepending filename with serial")
-            self.process_prepend_filename_with_serial()
+        # Absolute so it stays valid when children run with another cwd
+        self.telemetry_path = "{}.bin".format(self.video_path)
+
+        # All outputs already exist and no renaming was requested, so
+        # there is nothing to do -- not even the ffprobe spawn
+        if (
+            not reprocess
+            and not prepend_filename_with_serial
+            and not append_filename_with_timestamp
+            and all(map(os.path.isfile, self.output_paths()))
+        ):
+            print(f"All outputs already exist for {self.filename}, skipping")
+            return
+
+        # Demux gpmd (plus fdsc when the serial is needed) in one ffmpeg
+        # pass; a pending rename forces the parse since the outputs will
+        # be written under the new filename
+        needs_serial = (
+            prepend_filename_with_serial and self.filename_contains_serial() is None
+        )
+        rename_requested = (
+            prepend_filename_with_serial or append_filename_with_timestamp
+        )
+        self.extract_telemetry(extract_fdsc=needs_serial, force=rename_requested)
 
-        if append_filename_with_timestamp:
-            print("Appending filename with timestamp")
-            self.append_filename_with_timestamp()
+        if rename_requested:
+            self.rename_video(
+                prepend_filename_with_serial, append_filename_with_timestamp
+            )
 
-        self.extract_telemetry()
         self.extract_all()
 
+    @property
+    def ffprobe_streams(self):
+        # Probed lazily so short-circuited runs never spawn ffprobe
+        if self._ffprobe_streams is None:
+            self._ffprobe_streams = GoProTelemetry.get_ffprobe_streams(self.video_path)
+            GoProTelemetry.ensure_valid_gopro_video(
+                self.video_path, self._ffprobe_streams
+            )
+        return self._ffprobe_streams
+
     def get_basename(self):
-        search = re.search(r"G[HXOP\d][AP\d][AR\d]\d{4}", self.filename)
+        search = BASENAME_RE.search(self.filename)
         if search:
             return search.group(0)
         else:
             raise Exception("{}: Unknown filename format!".format(self.video_path))
 
-    def process_prepend_filename_with_serial(self):
-        self.camera_serial = self.filename_contains_serial()
-        if not self.camera_serial:
-            self.camera_serial = self.retrieve_camera_serial()
-            # Derive new filename and relevant paths
-            new_filename = "{}_{}".format(self.camera_serial, self.filename)
-            new_video_path = self.video_path.replace(self.filename, new_filename)
-            new_telemetry_path = self.telemetry_path.replace(
-                self.filename, new_filename
-            )
-
-            # Update with new values
-            self.filename = new_filename
-            os.rename(self.video_path, new_video_path)
-            self.video_path = new_video_path
-            self.telemetry_path = new_telemetry_path
-
-    def append_filename_with_timestamp(self):
-        self.creation_time = self.get_creation_time()
-        timestamp = self.creation_time.strftime("%Y-%m-%dT%H%M%S")
-        if timestamp not in self.filename:
-            # Derive new filename and relevant paths
-            new_filename = self.filename.replace(".MP4", "_{}.MP4".format(timestamp))
-            new_video_path = self.video_path.replace(self.filename, new_filename)
-            new_telemetry_path = self.telemetry_path.replace(
-                self.filename, new_filename
-            )
-
-            # Update with new values
+    def rename_video(self, prepend_serial, append_timestamp):
+        # Compose the final filename first so both options cost a single
+        # rename of the video
+        new_filename = self.filename
+        if prepend_serial:
+            print("Prepending filename with serial")
+            self.camera_serial = self.filename_contains_serial()
+            if not self.camera_serial:
+                self.camera_serial = self.retrieve_camera_serial()
+                new_filename = "{}_{}".format(self.camera_serial, new_filename)
+        if append_timestamp:
+            print("Appending filename with timestamp")
+            timestamp = self.creation_time.strftime("%Y-%m-%dT%H%M%S")
+            if timestamp not in new_filename:
+                new_filename = new_filename.replace(".MP4", "_{}.MP4".format(timestamp))
+        if new_filename != self.filename:
+            # os.replace is atomic and, unlike os.rename, also succeeds
+            # on Windows when the target already exists
+            new_video_path = os.path.join(self.video_dir, new_filename)
+            os.replace(self.video_path, new_video_path)
             self.filename = new_filename
-            os.rename(self.video_path, new_video_path)
             self.video_path = new_video_path
-            self.telemetry_path = new_telemetry_path
+            self.telemetry_path = "{}.bin".format(new_video_path)
 
     def load_executables(self, config_path):
         config_path = os.path.join(os.path.dirname(__file__), config_path)
         print(f"Loading config from {config_path}")
-        with open(config_path, "r") as cfg:
-            # load go pro 2
-            gopro_lib = yaml.safe_load(cfg)["gopro2"]
-        self.gopro2gpx_path = os.path.expanduser(gopro_lib["to_gpx"])
-        self.gopro2json_path = os.path.expanduser(gopro_lib["to_json"])
+        # load go pro 2; parsed once per path, then served from the cache
+        gopro_lib = _load_config(config_path)
         self.gpmdinfo_path = os.path.expanduser(gopro_lib["gpmd_info"])
-        self.gopro2csv_path = os.path.expanduser(gopro_lib["to_csv"])
-        self.gps2kml_path = os.path.expanduser(gopro_lib["gps2kml"])
 
-    def extract_telemetry(self):
+    def output_paths(self):
+        return [
+            os.path.join(self.video_dir, self.filename + extension)
+            for extension in (".gpx", ".json", ".csv", ".kml")
+        ]
+
+    def extract_telemetry(self, extract_fdsc=False, force=False):
         print("Extracting telemetry")
-        # If reprocessing or telemetry binary does not yet exists
-        if self.reprocess or not os.path.isfile(self.telemetry_path):
+        # If reprocessing or any of the output files does not yet exist,
+        # pipe the gpmd stream straight out of ffmpeg and parse it once
+        if force or self.reprocess or not all(map(os.path.isfile, self.output_paths())):
             stream_index = self.get_stream_index("gpmd")
             command = GoProTelemetry.ffmpeg_command(
-                self.video_path, stream_index, self.telemetry_path
+                self.video_path, stream_index, "pipe:1"
             )
-            GoProTelemetry.call_subprocess(command)
+            fdsc_path = None
+            if extract_fdsc:
+                # Piggyback the fdsc dump on the same demux pass instead
+                # of spawning a second ffmpeg for it
+                fdsc_path = "{}_fdsc.bin".format(self.video_path)
+                command += [
+                    "-codec",
+                    "copy",
+                    "-map",
+                    "0:" + str(self.get_stream_index("fdsc")),
+                    "-f",
+                    "rawvideo",
+                    "-fs",
+                    "101",
+                    fdsc_path,
+                ]
+            # A 1 MiB pipe buffer keeps ffmpeg from stalling on the
+            # default 4-64 KiB reads while the stream is drained
+            p = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=1 << 20)
+            raw = p.stdout.read()
+            p.wait()
+            if p.returncode != 0:
+                raise subprocess.CalledProcessError(p.returncode, " ".join(command))
+            self.telemetry = gpmf.parse(raw)
+            if fdsc_path:
+                with open(fdsc_path, "rb") as f:
+                    f.read(87)
+                    self._fdsc_serial = f.read(14).decode("utf-8")
+                os.remove(fdsc_path)  # delete temp file
 
     def extract_all(self):
-        self.extract_gpx()
-        self.extract_json()
-        # self.extract_metadata()
-        self.extract_csv()
-        self.extract_kml()
+        # The four outputs are independent, so format and write them
+        # concurrently instead of back to back
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+            futures = [
+                pool.submit(self.extract_gpx),
+                pool.submit(self.extract_json),
+                # pool.submit(self.extract_metadata),
+                pool.submit(self.extract_csv),
+                pool.submit(self.extract_kml),
+            ]
+            for future in futures:
+                future.result()
 
     def extract_gpx(self):
         gpx_path = os.path.join(self.video_dir, self.filename + ".gpx")
         print(f"Extracting GPX to {gpx_path}")
         # If reprocessing or gpx file does not yet exists
         if self.reprocess or not os.path.isfile(gpx_path):
-            command = [self.gopro2gpx_path, "-i", self.telemetry_path, "-o", gpx_path]
-            GoProTelemetry.call_subprocess(command)
+            self.write_output(gpx_path, gpmf.to_gpx(self.telemetry))
 
     def extract_json(self):
         json_path = os.path.join(self.video_dir, self.filename + ".json")
         print(f"Extracting JSON {json_path}")
         # If reprocessing or json file does not yet exists
         if self.reprocess or not os.path.isfile(json_path):
-            command = [self.gopro2json_path, "-i", self.telemetry_path, "-o", json_path]
-            GoProTelemetry.call_subprocess(command)
+            self.write_output(json_path, gpmf.to_json(self.telemetry))
 
     def extract_metadata(self):
         gps_path = os.path.join(self.video_dir, self.filename + "_gps.csv")
@@ -145,77 +234,114 @@ class GoProTelemetry(object):
             and os.path.isfile(accl_path)
             and os.path.isfile(temp_path)
         ):
+            self.ensure_telemetry_file()
             command = [self.gpmdinfo_path, "-i", self.telemetry_path]
             print("Running command: {}".format(" ".join(command)))
-            GoProTelemetry.call_subprocess(command)
-
-            # Rename and move files into video directory
-            shutil.move("./gps.csv", gps_path)
-            shutil.move("./gyro.csv", gyro_path)
-            shutil.move("./accl.csv", accl_path)
-            shutil.move("./temp.csv", temp_path)
+            # gpmdinfo drops its CSVs in the working directory; run it in
+            # the video directory so they land on the right filesystem
+            # and do not collide with other runs sharing this cwd
+            GoProTelemetry.call_subprocess(command, cwd=self.video_dir)
+
+            # Prefix the CSVs with the video filename; same-directory
+            # renames, so no cross-filesystem copies
+            os.replace(os.path.join(self.video_dir, "gps.csv"), gps_path)
+            os.replace(os.path.join(self.video_dir, "gyro.csv"), gyro_path)
+            os.replace(os.path.join(self.video_dir, "accl.csv"), accl_path)
+            os.replace(os.path.join(self.video_dir, "temp.csv"), temp_path)
 
     def extract_csv(self):
         csv_path = os.path.join(self.video_dir, self.filename + ".csv")
         print(f"Extracting CSV to {csv_path}")
         # If reprocessing or csv file does not yet exists
         if self.reprocess or not os.path.isfile(csv_path):
-            command = [self.gopro2csv_path, "-i", self.telemetry_path, "-o", csv_path]
-            GoProTelemetry.call_subprocess(command)
+            self.write_output(csv_path, gpmf.to_csv(self.telemetry))
 
     def extract_kml(self):
         kml_path = os.path.join(self.video_dir, self.filename + ".kml")
         print(f"Extracting KML to {kml_path}")
         # If reprocessing or csv file does not yet exists
         if self.reprocess or not os.path.isfile(kml_path):
-            command = [self.gps2kml_path, "-i", self.telemetry_path, "-o", kml_path]
+            self.write_output(kml_path, gpmf.to_kml(self.telemetry))
+
+    @staticmethod
+    def write_output(path, text):
+        # Encode once and hand the whole buffer to the kernel in a
+        # single unbuffered write instead of chunked text-mode flushes
+        with open(path, "wb", buffering=0) as f:
+            f.write(text.encode("utf-8"))
+
+    def ensure_telemetry_file(self):
+        # gpmdinfo still reads the raw stream from a file on disk
+        if self.reprocess or not os.path.isfile(self.telemetry_path):
+            stream_index = self.get_stream_index("gpmd")
+            command = GoProTelemetry.ffmpeg_command(
+                self.video_path, stream_index, self.telemetry_path
+            )
             GoProTelemetry.call_subprocess(command)
 
-    def get_creation_time(self):
+    @functools.cached_property
+    def creation_time(self):
         timestamp = self.ffprobe_streams["format"]["tags"]["creation_time"]
-        return dateutil.parser.parse(timestamp)
-
-    def get_firmware_version(self):
+        # GoPro writes ISO-8601; fromisoformat is ~10x faster than dateutil
+        try:
+            return datetime.datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+        except ValueError:
+            return dateutil.parser.parse(timestamp)
+
+    @functools.cached_property
+    def firmware_version(self):
         return self.ffprobe_streams["format"]["tags"]["firmware"]
 
     def filename_contains_serial(self):
-        # See https://gopro.com/help/articles/How_To/How-to-Find-Your-GoPro-Serial-Number
-        serial_regex = [
-            (r"C33.{11}"),  # GoPro HERO (2018).  14 char beginning with "C33"
-            (r"C322.{10}"),  # HERO6 Black.        14 char beginning with "C322"
-            (r"C32.{11}"),  # HERO5 Session.      14 char beginning with "C32"
-            (
-                r"C31.{11}"
-            ),  # HERO5 Black, HERO4, HERO Session, HERO4 Session, HERO+ LCD, HERO+, HERO. 14 char beginning with "C31"
-            (r"H3.{13}"),  # HERO3+.             15-char beginning with "H3"
-            (r"HD3.{12}"),  # HERO3.              15 char beginning with "HD3"
-            (r"H2.{12}"),  # HD HERO2.           14 char beginning with "H2"
-            (r"HD2.{11}"),  # HD HERO 960.        14 char beginning with "HD2"
-            (r"HD1.{10}"),  # HD HERO (Original). 13 char beginning with "HD1"
-        ]
-        for regex in serial_regex:
-            check = re.search(regex, self.filename)
-            if check:
-                return check.group(0)
+        check = SERIAL_RE.search(self.filename)
+        if check:
+            return check.group(0)
         return None
 
     def retrieve_camera_serial(self):
+        if self._fdsc_serial:
+            return self._fdsc_serial
         stream_index = self.get_stream_index("fdsc")
-        temp_output_path = "{}_fdsc.bin".format(self.video_path)
+        # Only bytes 87-101 hold the serial, so cap the dump at 101 bytes
+        # and pipe it instead of extracting the whole stream to a file
         command = GoProTelemetry.ffmpeg_command(
-            self.video_path, stream_index, temp_output_path
+            self.video_path, stream_index, "pipe:1", max_bytes=101
         )
-        GoProTelemetry.call_subprocess(command)
-        with open(temp_output_path, "rb") as f:
-            f.read(87)
-            camera_serial = f.read(14).decode("utf-8")
-        os.remove(temp_output_path)  # delete temp file
-        return camera_serial
+        p = subprocess.run(command, stdout=subprocess.PIPE)
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, " ".join(command))
+        return p.stdout[87:101].decode("utf-8")
+
+    @functools.cached_property
+    def _stream_index_by_tag(self):
+        # setdefault keeps the first stream per tag, like the old scan did
+        index_by_tag = {}
+        for track in self._probe_tracks():
+            index_by_tag.setdefault(track["codec_tag_string"], track["index"])
+        return index_by_tag
+
+    def _probe_tracks(self):
+        # Parsing the moov atom in-process covers the common case and
+        # skips the ffprobe spawn; ffprobe stays as the fallback
+        try:
+            tracks = mp4probe.parse_tracks(self.video_path)
+        except mp4probe.MoovParseError:
+            return [
+                {
+                    "index": stream["index"],
+                    "codec_tag_string": stream["codec_tag_string"],
+                    "handler_name": stream.get("tags", {}).get("handler_name", ""),
+                }
+                for stream in self.ffprobe_streams["streams"]
+            ]
+        if not any("GoPro" in track["handler_name"] for track in tracks):
+            raise Exception("{} is not a GoPro video!".format(self.video_path))
+        return tracks
 
     def get_stream_index(self, code_tag_string):
-        for stream in self.ffprobe_streams["streams"]:
-            if stream["codec_tag_string"] == code_tag_string:
-                return stream["index"]
+        # Raises KeyError when the stream is absent, rather than
+        # returning a silent None
+        return self._stream_index_by_tag[code_tag_string]
 
     @staticmethod
     def ensure_valid_path(file_path):
@@ -224,6 +350,38 @@ class GoProTelemetry(object):
 
     @staticmethod
     def get_ffprobe_streams(video_path):
+        stat = os.stat(video_path)
+        return GoProTelemetry._cached_ffprobe_streams(
+            os.path.abspath(video_path), stat.st_mtime_ns, stat.st_size
+        )
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _cached_ffprobe_streams(video_path, mtime_ns, size):
+        # Probe results are cached on disk next to the videos so batch
+        # re-runs over already-processed files skip the ffprobe spawn
+        cache_path = os.path.join(os.path.dirname(video_path), ".ffprobe_cache.json")
+        cache_key = "{}:{}:{}".format(video_path, mtime_ns, size)
+        cache = {}
+        if os.path.isfile(cache_path):
+            try:
+                with open(cache_path, "r") as f:
+                    cache = json.load(f)
+            except (OSError, ValueError):
+                cache = {}
+        if cache_key in cache:
+            return cache[cache_key]
+        streams = GoProTelemetry._run_ffprobe(video_path)
+        cache[cache_key] = streams
+        try:
+            with open(cache_path, "w") as f:
+                json.dump(cache, f)
+        except OSError:
+            pass  # cache is best-effort, e.g. read-only video dir
+        return streams
+
+    @staticmethod
+    def _run_ffprobe(video_path):
         command = [
             "ffprobe",
             "-i",
@@ -236,26 +394,26 @@ class GoProTelemetry(object):
             "-show_streams",
             "-hide_banner",
         ]
-        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = p.communicate()
-        if err:
-            print(err)
-            return None
-        return json.loads(out.decode("utf-8"))
+        # ffprobe writes warnings to stderr even on success, so trust the
+        # exit code rather than stderr being non-empty
+        r = subprocess.run(command, capture_output=True, check=True)
+        # orjson parses the bytes directly, without the UTF-8 decode
+        if orjson is not None:
+            return orjson.loads(r.stdout)
+        return json.loads(r.stdout)
 
     @staticmethod
     def ensure_valid_gopro_video(video_path, ffprobe_streams):
-        found_gopro_indicator = False
-        for stream in ffprobe_streams["streams"]:
-            if "GoPro" in stream["tags"]["handler_name"]:
-                found_gopro_indicator = True
-                break
-        if not found_gopro_indicator:
+        # Data streams may lack tags entirely, so guard the lookups
+        if not any(
+            "GoPro" in stream.get("tags", {}).get("handler_name", "")
+            for stream in ffprobe_streams["streams"]
+        ):
             raise Exception("{} is not a GoPro video!".format(video_path))
 
     @staticmethod
-    def ffmpeg_command(video_path, stream_index, output_path):
-        return [
+    def ffmpeg_command(video_path, stream_index, output_path, max_bytes=None):
+        command = [
             "ffmpeg",
             "-v",
             "quiet",
@@ -268,23 +426,65 @@ class GoProTelemetry(object):
             "0:" + str(stream_index),
             "-f",
             "rawvideo",
-            output_path,
         ]
+        if max_bytes is not None:
+            # -fs stops writing once the output exceeds this size
+            command += ["-fs", str(max_bytes)]
+        command.append(output_path)
+        return command
 
     @staticmethod
-    def call_subprocess(command):
-        c = subprocess.run(command)
+    def call_subprocess(command, cwd=None):
+        c = subprocess.run(command, cwd=cwd)
         if c.returncode != 0:
             raise subprocess.CalledProcessError(c.returncode, " ".join(command))
 
 
+def _process_video(video_path, reprocess, config_path):
+    GoProTelemetry(video_path, reprocess=reprocess, config_path=config_path)
+    return video_path
+
+
+def process_directory(
+    video_dir, reprocess=False, config_path="config.yml", workers=None
+):
+    """Process every GoPro video in video_dir, one worker process per video.
+
+    The videos are independent (disjoint input and output paths), so a
+    ProcessPoolExecutor scales the batch close to linearly with cores.
+    """
+    pattern = os.path.join(video_dir, "G[HXOP]*.MP4")
+    video_paths = sorted(glob.glob(pattern))
+    if not video_paths:
+        print(f"No GoPro videos found in {video_dir}")
+        return []
+    workers = workers or os.cpu_count()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(_process_video, path, reprocess, config_path): path
+            for path in video_paths
+        }
+        for future in concurrent.futures.as_completed(futures):
+            future.result()  # re-raise worker failures here
+    return video_paths
+
+
 if __name__ == "__main__":
     # write code parser arguments with video path
     parser = argparse.ArgumentParser(description="Extract telemetry from GoPro video")
     parser.add_argument("--video_path", type=str, help="Path to GoPro video")
+    parser.add_argument(
+        "--video_dir", type=str, help="Process every GoPro video in this directory"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None, help="Worker processes for --video_dir"
+    )
     args = parser.parse_args()
 
     # extract telemetry
-    gopro_telemetry = GoProTelemetry(
-        args.video_path, reprocess=True, config_path="config.yml"
-    )
+    if args.video_dir:
+        process_directory(args.video_dir, reprocess=True, workers=args.workers)
+    else:
+        gopro_telemetry = GoProTelemetry(
+            args.video_path, reprocess=True, config_path="config.yml"
+        )
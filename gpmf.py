@@ -0,0 +1,266 @@
+"""Minimal in-process parser for the GoPro GPMF (gpmd) telemetry stream.
+
+GPMF is a nested KLV format: each record has a 4-byte FourCC key, a 1-byte
+type character, a 1-byte structure size and a 2-byte big-endian repeat count,
+followed by ``size * repeat`` payload bytes padded to a 4-byte boundary.
+A type byte of 0 marks a nested container (DEVC/STRM).
+
+See https://github.com/gopro/gpmf-parser for the format reference.
+"""
+
+import datetime
+import json
+import struct
+
+
+# GPMF type character -> struct format character (big-endian)
+TYPE_FORMATS = {
+    ord("b"): "b",
+    ord("B"): "B",
+    ord("s"): "h",
+    ord("S"): "H",
+    ord("l"): "l",
+    ord("L"): "L",
+    ord("f"): "f",
+    ord("d"): "d",
+    ord("j"): "q",
+    ord("J"): "Q",
+}
+
+
+def iter_klv(data, start, end):
+    """Yield (key, type_char, size, repeat, payload_start, payload_end)
+    for each KLV record between start and end."""
+    offset = start
+    while offset + 8 <= end:
+        key = bytes(data[offset : offset + 4])
+        type_char = data[offset + 4]
+        size = data[offset + 5]
+        repeat = (data[offset + 6] << 8) | data[offset + 7]
+        length = size * repeat
+        payload_start = offset + 8
+        yield key, type_char, size, repeat, payload_start, payload_start + length
+        # Payloads are padded to 32-bit alignment
+        offset = payload_start + ((length + 3) & ~3)
+
+
+# (type_char, size) -> (struct.Struct, values per sample); built lazily
+# so each sample layout is compiled exactly once per process
+_UNPACKERS = {}
+
+
+def decode_values(data, type_char, size, repeat, start, end):
+    """Decode a KLV payload into a list of scalars (repeat == 1 and one
+    value per sample) or a list of tuples (one tuple per sample)."""
+    fmt = TYPE_FORMATS.get(type_char)
+    if fmt is None:
+        return None
+    cached = _UNPACKERS.get((type_char, size))
+    if cached is None:
+        item_size = struct.calcsize(">" + fmt)
+        per_sample = size // item_size
+        cached = (struct.Struct(">" + fmt * per_sample), per_sample)
+        _UNPACKERS[(type_char, size)] = cached
+    unpacker, per_sample = cached
+    if unpacker.size == size:
+        # Bulk-decode the whole payload in one C-level pass
+        if per_sample == 1:
+            return [sample[0] for sample in unpacker.iter_unpack(data[start:end])]
+        return list(unpacker.iter_unpack(data[start:end]))
+    # Samples carry trailing padding; fall back to a per-sample walk
+    values = []
+    for i in range(repeat):
+        sample = unpacker.unpack_from(data, start + i * size)
+        values.append(sample[0] if per_sample == 1 else sample)
+    return values
+
+
+def parse_gpsu(raw):
+    # GPSU is a 16-char UTC string in yymmddhhmmss.sss form
+    text = raw.decode("ascii", errors="replace").strip("\x00")
+    try:
+        parsed = datetime.datetime.strptime(text, "%y%m%d%H%M%S.%f")
+        return parsed.replace(tzinfo=datetime.timezone.utc)
+    except ValueError:
+        return None
+
+
+def _scale(values, scal):
+    if not scal:
+        return [float(v) for v in values]
+    return [v / s for v, s in zip(values, scal)]
+
+
+def parse(data):
+    """Parse a raw gpmd byte stream into telemetry sample lists.
+
+    Returns a dict with keys "gps", "gyro", "accl" and "temp". GoPro
+    emits one DEVC payload per second, so sample timestamps are assigned
+    by spreading each payload's samples evenly across its second, which
+    matches what the gopro-utils gpmdinfo tool does.
+    """
+    telemetry = {"gps": [], "gyro": [], "accl": [], "temp": []}
+    data = memoryview(data)  # zero-copy slicing while walking the KLVs
+    payload_index = 0
+    for key, type_char, size, repeat, start, end in iter_klv(data, 0, len(data)):
+        if key != b"DEVC" or type_char != 0:
+            continue
+        base_ms = payload_index * 1000
+        for skey, stype, ssize, srepeat, sstart, send in iter_klv(data, start, end):
+            if skey == b"STRM" and stype == 0:
+                _parse_stream(data, sstart, send, base_ms, telemetry)
+            elif skey == b"TMPC":
+                values = decode_values(data, stype, ssize, srepeat, sstart, send)
+                if values:
+                    telemetry["temp"].append((base_ms, values[0]))
+        payload_index += 1
+    return telemetry
+
+
+def _parse_stream(data, start, end, base_ms, telemetry):
+    scal = None
+    gpsu = None
+    gpsf = None
+    gpsp = None
+    samples = {}
+    for key, type_char, size, repeat, pstart, pend in iter_klv(data, start, end):
+        if key == b"SCAL":
+            values = decode_values(data, type_char, size, repeat, pstart, pend)
+            if values:
+                scal = values if not isinstance(values[0], tuple) else list(values[0])
+        elif key == b"GPSU":
+            gpsu = parse_gpsu(bytes(data[pstart:pend]))
+        elif key == b"GPSF":
+            values = decode_values(data, type_char, size, repeat, pstart, pend)
+            gpsf = values[0] if values else None
+        elif key == b"GPSP":
+            values = decode_values(data, type_char, size, repeat, pstart, pend)
+            gpsp = values[0] if values else None
+        elif key in (b"GPS5", b"GYRO", b"ACCL", b"TMPC"):
+            samples[key] = decode_values(data, type_char, size, repeat, pstart, pend)
+
+    if b"GPS5" in samples and samples[b"GPS5"]:
+        values = samples[b"GPS5"]
+        step = 1000.0 / len(values)
+        for i, sample in enumerate(values):
+            lat, lon, alt, speed2d, speed3d = _scale(sample, scal)
+            utc = None
+            if gpsu:
+                utc = gpsu + datetime.timedelta(milliseconds=i * step)
+            telemetry["gps"].append(
+                {
+                    "ms": base_ms + i * step,
+                    "lat": lat,
+                    "lon": lon,
+                    "alt": alt,
+                    "speed2d": speed2d,
+                    "speed3d": speed3d,
+                    "utc": utc,
+                    "fix": gpsf,
+                    "precision": gpsp,
+                }
+            )
+    for key, bucket in ((b"GYRO", "gyro"), (b"ACCL", "accl")):
+        if key in samples and samples[key]:
+            values = samples[key]
+            step = 1000.0 / len(values)
+            divisor = scal[0] if scal else 1.0
+            for i, sample in enumerate(values):
+                x, y, z = (v / divisor for v in sample)
+                telemetry[bucket].append((base_ms + i * step, x, y, z))
+    if b"TMPC" in samples and samples[b"TMPC"]:
+        telemetry["temp"].append((base_ms, samples[b"TMPC"][0]))
+
+
+def _isoformat(utc):
+    return utc.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z" if utc else ""
+
+
+def _epoch_ms(utc):
+    return int(utc.timestamp() * 1000) if utc else 0
+
+
+def to_gpx(telemetry):
+    """Render GPS samples as a GPX 1.1 track."""
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<gpx version="1.1" creator="gopro-telemetry-export"',
+        '     xmlns="http://www.topografix.com/GPX/1/1">',
+        "  <trk>",
+        "    <trkseg>",
+    ]
+    for point in telemetry["gps"]:
+        lines.append(
+            '      <trkpt lat="{:.7f}" lon="{:.7f}">'.format(point["lat"], point["lon"])
+        )
+        lines.append("        <ele>{:.2f}</ele>".format(point["alt"]))
+        if point["utc"]:
+            lines.append("        <time>{}</time>".format(_isoformat(point["utc"])))
+        lines.append("      </trkpt>")
+    lines.append("    </trkseg>")
+    lines.append("  </trk>")
+    lines.append("</gpx>")
+    return "\n".join(lines) + "\n"
+
+
+def to_json(telemetry):
+    """Render all telemetry samples as a JSON document."""
+    document = {
+        "data": [
+            {
+                "ms": point["ms"],
+                "lat": point["lat"],
+                "lon": point["lon"],
+                "alt": point["alt"],
+                "speed2d": point["speed2d"],
+                "speed3d": point["speed3d"],
+                "utc": _isoformat(point["utc"]),
+                "fix": point["fix"],
+                "precision": point["precision"],
+            }
+            for point in telemetry["gps"]
+        ],
+        "gyro": telemetry["gyro"],
+        "accl": telemetry["accl"],
+        "temp": telemetry["temp"],
+    }
+    return json.dumps(document)
+
+
+def to_csv(telemetry):
+    """Render GPS samples as CSV with the same columns gpmdinfo used."""
+    lines = ["Latitude,Longitude,Altitude,Speed,Speed3D,TS"]
+    for point in telemetry["gps"]:
+        lines.append(
+            "{:.7f},{:.7f},{:.2f},{:.3f},{:.3f},{}".format(
+                point["lat"],
+                point["lon"],
+                point["alt"],
+                point["speed2d"],
+                point["speed3d"],
+                _epoch_ms(point["utc"]),
+            )
+        )
+    return "\n".join(lines) + "\n"
+
+
+def to_kml(telemetry):
+    """Render GPS samples as a KML LineString."""
+    coordinates = " ".join(
+        "{:.7f},{:.7f},{:.2f}".format(point["lon"], point["lat"], point["alt"])
+        for point in telemetry["gps"]
+    )
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<kml xmlns="http://www.opengis.net/kml/2.2">',
+        "  <Document>",
+        "    <Placemark>",
+        "      <LineString>",
+        "        <altitudeMode>absolute</altitudeMode>",
+        "        <coordinates>{}</coordinates>".format(coordinates),
+        "      </LineString>",
+        "    </Placemark>",
+        "  </Document>",
+        "</kml>",
+    ]
+    return "\n".join(lines) + "\n"
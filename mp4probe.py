@@ -0,0 +1,116 @@
+"""Minimal in-process MP4 box parser for GoPro videos.
+
+Walks the ``moov`` atom to recover, per track, the handler name (from
+``moov/trak/mdia/hdlr``) and the codec tag (from the first ``stsd``
+sample entry). That is all GoProTelemetry needs to locate the ``gpmd``
+and ``fdsc`` streams, so the ffprobe spawn can be skipped in the common
+case; callers fall back to ffprobe when parsing fails.
+
+Only the box headers and the moov atom itself are read -- the mdat
+payload is seeked over, never loaded.
+"""
+
+import io
+import struct
+
+
+class MoovParseError(Exception):
+    """Raised when the moov atom is missing or malformed."""
+
+
+def _iter_boxes(data, start, end):
+    """Yield (box_type, payload_start, payload_end) between start and end."""
+    offset = start
+    while offset + 8 <= end:
+        (size,) = struct.unpack_from(">I", data, offset)
+        box_type = bytes(data[offset + 4 : offset + 8])
+        header = 8
+        if size == 1:
+            (size,) = struct.unpack_from(">Q", data, offset + 8)
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header or offset + size > end:
+            raise MoovParseError("malformed box at offset {}".format(offset))
+        yield box_type, offset + header, offset + size
+        offset += size
+
+
+def _find(data, start, end, box_name):
+    for box_type, payload_start, payload_end in _iter_boxes(data, start, end):
+        if box_type == box_name:
+            return payload_start, payload_end
+    return None
+
+
+def _read_moov(video_path):
+    """Seek through the top-level boxes and return the moov payload."""
+    with open(video_path, "rb") as f:
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise MoovParseError("no moov atom in {}".format(video_path))
+            (size,) = struct.unpack(">I", header[:4])
+            box_type = header[4:8]
+            header_size = 8
+            if size == 1:
+                (size,) = struct.unpack(">Q", f.read(8))
+                header_size = 16
+            if box_type == b"moov":
+                if size == 0:
+                    return f.read()
+                return f.read(size - header_size)
+            if size == 0:  # box extends to end of file
+                raise MoovParseError("no moov atom in {}".format(video_path))
+            f.seek(size - header_size, io.SEEK_CUR)
+
+
+def _handler_name(moov, start, end):
+    # hdlr payload: version/flags, pre_defined, handler_type, 3x reserved,
+    # then the name -- either NUL-terminated or a QuickTime counted string
+    name = moov[start + 24 : end]
+    if name and not 32 <= name[0] < 127:
+        name = name[1:]
+    return name.rstrip(b"\x00").decode("utf-8", errors="replace").strip()
+
+
+def _codec_tag(moov, start, end):
+    # stsd payload: version/flags, entry_count, then the first sample
+    # entry (size, format); the format FourCC is the codec tag
+    if end - start < 16:
+        return ""
+    return moov[start + 12 : start + 16].decode("latin-1").strip("\x00")
+
+
+def parse_tracks(video_path):
+    """Return [{"index", "codec_tag_string", "handler_name"}, ...] per trak."""
+    try:
+        moov = _read_moov(video_path)
+        tracks = []
+        for box_type, start, end in _iter_boxes(moov, 0, len(moov)):
+            if box_type != b"trak":
+                continue
+            handler_name = ""
+            codec_tag = ""
+            mdia = _find(moov, start, end, b"mdia")
+            if mdia:
+                hdlr = _find(moov, mdia[0], mdia[1], b"hdlr")
+                if hdlr:
+                    handler_name = _handler_name(moov, hdlr[0], hdlr[1])
+                minf = _find(moov, mdia[0], mdia[1], b"minf")
+                stbl = minf and _find(moov, minf[0], minf[1], b"stbl")
+                stsd = stbl and _find(moov, stbl[0], stbl[1], b"stsd")
+                if stsd:
+                    codec_tag = _codec_tag(moov, stsd[0], stsd[1])
+            tracks.append(
+                {
+                    "index": len(tracks),
+                    "codec_tag_string": codec_tag,
+                    "handler_name": handler_name,
+                }
+            )
+    except struct.error as exc:
+        raise MoovParseError(str(exc))
+    if not tracks:
+        raise MoovParseError("no trak boxes in {}".format(video_path))
+    return tracks